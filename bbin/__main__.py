@@ -1,12 +1,22 @@
 """Main entry point."""
 import os
 import os.path
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional, Tuple, Union
+from typing import Any, Callable, Dict, Optional, Tuple, Union
 
 import click
 
-from . import bbin, enums, utils
+from . import (
+    bbin,
+    compiler_cache,
+    daemon,
+    enums,
+    history,
+    interface,
+    lockfile,
+    utils,
+)
 
 
 class Installable(click.ParamType):
@@ -28,50 +38,269 @@ class Installable(click.ParamType):
         return enums.InstallType.PKG, value
 
 
+def path_options(function: Callable[..., Any]) -> Callable[..., Any]:  # type: ignore
+    """Add the options shared by every command that needs an index"""
+    function = click.option(
+        "--app-path",
+        default=lambda: os.getenv("APP_PATH", os.path.expanduser("~/app")),
+    )(function)
+    function = click.option(
+        "--bin-path",
+        default=lambda: os.getenv("BIN_PATH", os.path.expanduser("~/bin")),
+    )(function)
+    function = click.option(
+        "--index-path",
+        default=lambda: os.getenv("BBIN_PATH", os.path.expanduser("~/.config/bbin")),
+    )(function)
+    return function
+
+
+def daemon_paths(index_path: str, bin_path: str, app_path: str) -> Dict[str, str]:
+    """Describe which index the daemon should use"""
+    return {
+        "bbin_path": os.path.abspath(index_path),
+        "bin_path": os.path.abspath(bin_path),
+        "app_path": os.path.abspath(app_path),
+    }
+
+
 @click.group()
 def main() -> None:
     """A binary package manager"""
 
 
 @main.command()  # type: ignore
-@click.argument("thing", type=Installable())
+@click.argument("things", metavar="THING...", nargs=-1, required=True, type=Installable())
 @click.option(
     "--action",
     default="move",
     type=click.Choice(["move", "symlink", "copy"], case_sensitive=False),
 )
 @click.option(
-    "--index-path",
-    default=lambda: os.getenv("BBIN_PATH", os.path.expanduser("~/.config/bbin")),
+    "--jobs",
+    "-j",
+    default=1,
+    type=click.IntRange(1),
+    help="How many packages to build at once",
 )
+@path_options
+def install(
+    things: Tuple[Tuple[enums.InstallType, Union[Path, str]], ...],
+    action: str,
+    jobs: int,
+    index_path: str,
+    bin_path: str,
+    app_path: str,
+) -> None:
+    """Install packages. Each THING must be a URL, a path to an executable, or a package's name."""
+    package_names = []
+    for thing in things:
+        if thing[0] == enums.InstallType.PKG:
+            assert isinstance(thing[1], str)
+            package_names.append(thing[1])
+        elif thing[0] == enums.InstallType.URL:
+            assert isinstance(thing[1], str)
+            ...
+        elif thing[0] == enums.InstallType.EXE:
+            assert isinstance(thing[1], Path)
+            ...
+    if not package_names:
+        return
+
+    installed = daemon.request(
+        "install",
+        packages=package_names,
+        action=action.lower(),
+        jobs=jobs,
+        environment=daemon.build_environment(),
+        **daemon_paths(index_path, bin_path, app_path),
+    )
+    if installed is None:
+        index = bbin.Index(bbin_path=index_path, bin_path=bin_path, app_path=app_path)
+        if jobs == 1:
+            index.install_packages(package_names, action.lower())
+        else:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                index.install_packages(package_names, action.lower(), executor=executor)
+        installed = package_names
+    interface.success(f"Installed {', '.join(installed)}")
+
+
+@main.command()  # type: ignore
+@click.argument("package_names", metavar="PACKAGE...", nargs=-1, required=True)
 @click.option(
-    "--bin-path", default=lambda: os.getenv("BIN_PATH", os.path.expanduser("~/bin"))
+    "--output",
+    "-o",
+    default=lockfile.FILE_NAME,
+    type=click.Path(dir_okay=False, writable=True),
+    help="Where to write the lockfile",
+)
+@path_options
+def lock(
+    package_names: Tuple[str, ...],
+    output: str,
+    index_path: str,
+    bin_path: str,
+    app_path: str,
+) -> None:
+    """Pin packages (URL, commit, compiler, and hashes) in a lockfile."""
+    index = bbin.Index(bbin_path=index_path, bin_path=bin_path, app_path=app_path)
+    packages = [index.lock_package(package_name) for package_name in package_names]
+    lockfile.dump(packages, Path(output))
+    interface.success(
+        f"Locked {len(packages)} package{'s' if len(packages) > 1 else ''} in {output}"
+    )
+
+
+@main.command()  # type: ignore
+@click.argument(
+    "lock_path",
+    metavar="LOCKFILE",
+    default=lockfile.FILE_NAME,
+    type=click.Path(exists=True, dir_okay=False),
 )
 @click.option(
-    "--app-path", default=lambda: os.getenv("APP_PATH", os.path.expanduser("~/app"))
+    "--action",
+    default="move",
+    type=click.Choice(["move", "symlink", "copy"], case_sensitive=False),
 )
-def install(
-    thing: Tuple[enums.InstallType, Union[Path, str]],
+@click.option(
+    "--jobs",
+    "-j",
+    default=1,
+    type=click.IntRange(1),
+    help="How many packages to build at once",
+)
+@path_options
+def sync(
+    lock_path: str,
     action: str,
+    jobs: int,
     index_path: str,
     bin_path: str,
     app_path: str,
 ) -> None:
-    """Install a package. THING must be a URL, a path to an executable, or a package's name."""
-    if thing[0] == enums.InstallType.PKG:
-        package_name = thing[1]
-        assert isinstance(package_name, str)
+    """Install exactly what LOCKFILE pins, skipping what is already installed."""
+    packages = list(lockfile.load(Path(lock_path)).values())
+    # Everything we need is in the lockfile, so leave the index alone
+    index = bbin.Index(
+        bbin_path=index_path, bin_path=bin_path, app_path=app_path, offline=True
+    )
+    if jobs == 1:
+        changed = index.sync_packages(packages, action.lower())
+    else:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            changed = index.sync_packages(packages, action.lower(), executor=executor)
+    if changed:
+        interface.success(f"Installed {', '.join(changed)}")
+    else:
+        interface.success("Everything is up to date")
+
+
+@main.command()  # type: ignore
+@click.argument("package_names", metavar="PACKAGE...", nargs=-1, required=True)
+@click.option(
+    "--jobs",
+    "-j",
+    default=1,
+    type=click.IntRange(1),
+    help="How many packages would be built at once",
+)
+@path_options
+def plan(
+    package_names: Tuple[str, ...],
+    jobs: int,
+    index_path: str,
+    bin_path: str,
+    app_path: str,
+) -> None:
+    """Show the order packages would be built in and how long it should take."""
+    # pylint: disable=unused-argument
+    build_plan = history.History(Path(index_path).joinpath(history.FILE_NAME)).plan(
+        list(package_names), jobs
+    )
+    for estimate in build_plan.estimates:
+        if estimate.seconds is None:
+            duration = "unknown"
+        else:
+            duration = history.format_duration(estimate.seconds)
+        line = f"{estimate.package_name}: {duration}"
+        if estimate.max_rss is not None:
+            line += f" (peak memory {estimate.max_rss // 1024} MiB)"
+        click.echo(line)
+    summary = (
+        f"Expected wall time with {jobs} job{'s' if jobs > 1 else ''}: "
+        f"{history.format_duration(build_plan.wall_time)}"
+    )
+    unknown = sum(estimate.seconds is None for estimate in build_plan.estimates)
+    if unknown:
+        summary += f" ({unknown} of the packages have never been built here)"
+    click.echo(summary)
+
+
+@main.command()  # type: ignore
+@click.argument("query")
+@path_options
+def search(query: str, index_path: str, bin_path: str, app_path: str) -> None:
+    """Search the index for packages whose name contains QUERY."""
+    found = daemon.request(
+        "search", query=query, **daemon_paths(index_path, bin_path, app_path)
+    )
+    if found is None:
         index = bbin.Index(bbin_path=index_path, bin_path=bin_path, app_path=app_path)
-        url = index.get_url(package_name)
-        if url is None:
-            raise click.BadParameter("Invalid package name: package not found")
-        index.install(index.build(index.download(package_name, url)), action.lower())
-    elif thing[0] == enums.InstallType.URL:
-        assert isinstance(thing[1], str)
-        ...
-    elif thing[0] == enums.InstallType.EXE:
-        assert isinstance(thing[1], Path)
-        ...
+        found = index.search(query)
+    for package_name in found:
+        click.echo(package_name)
+
+
+@main.command("list")  # type: ignore
+@path_options
+def list_(index_path: str, bin_path: str, app_path: str) -> None:
+    """List installed packages."""
+    installed = daemon.request("list", **daemon_paths(index_path, bin_path, app_path))
+    if installed is None:
+        index = bbin.Index(bbin_path=index_path, bin_path=bin_path, app_path=app_path)
+        installed = index.installed()
+    for package_name in installed:
+        click.echo(package_name)
+
+
+def index_cache(index_path: str) -> compiler_cache.CompilerCache:
+    return compiler_cache.CompilerCache(
+        Path(index_path).joinpath(compiler_cache.DIRECTORY_NAME)
+    )
+
+
+@main.group()  # type: ignore
+def cache() -> None:
+    """Manage the compiler cache (limit its size with BBIN_CACHE_SIZE)."""
+
+
+@cache.command()  # type: ignore
+@path_options
+def stats(index_path: str, bin_path: str, app_path: str) -> None:
+    """Show how well the compiler cache is doing."""
+    # pylint: disable=unused-argument
+    cache_stats = index_cache(index_path).stats()
+    hit_rate = cache_stats.hit_rate
+    click.echo(f"Hits: {cache_stats.hits}")
+    click.echo(f"Misses: {cache_stats.misses}")
+    click.echo(f"Uncacheable: {cache_stats.uncacheable}")
+    click.echo(f"Hit rate: {'n/a' if hit_rate is None else f'{hit_rate:.0%}'}")
+    click.echo(
+        f"Size: {compiler_cache.format_size(cache_stats.size)} "
+        f"of {compiler_cache.format_size(cache_stats.max_size)} "
+        f"({cache_stats.entries} entries)"
+    )
+
+
+@cache.command()  # type: ignore
+@path_options
+def clear(index_path: str, bin_path: str, app_path: str) -> None:
+    """Empty the compiler cache and reset its statistics."""
+    # pylint: disable=unused-argument
+    index_cache(index_path).clear()
+    interface.success("Cleared the compiler cache")
 
 
 if __name__ == "__main__":
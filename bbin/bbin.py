@@ -1,16 +1,30 @@
 """BinBin object definition"""
+import contextlib
+import functools
 import json
+import os
 import shutil
 import subprocess
 import tempfile
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, wait
 from pathlib import Path
-from typing import Dict, List, Optional, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import click
 import halo  # type: ignore
 import userpath  # type: ignore
 
-from . import dep_resolver, enums, git, interface, json_to_obj, utils
+from . import (
+    compiler_cache,
+    dep_resolver,
+    enums,
+    git,
+    history,
+    interface,
+    json_to_obj,
+    lockfile,
+    utils,
+)
 
 BBIN_URL = "https://github.com/ThatXliner/binbin_files.git"
 
@@ -22,6 +36,7 @@ class Index:
         bbin_path: str = "~/.config/binbin",
         bin_path: str = "~/bin",
         app_path: str = "~/app",
+        offline: bool = False,
     ):
         bbin_dir = Path(bbin_path)
         binaries_dir = Path(bin_path)
@@ -30,15 +45,19 @@ class Index:
         self._bbin_path = bbin_dir
         self._app_path = app_dir
         self._bin_path = binaries_dir
+        # Parsed JSON files keyed by path, invalidated by modification time
+        self._json_cache: Dict[Path, Tuple[float, Any]] = {}
+        self.history = history.History(self.history_path)
+        self.sync_state = lockfile.SyncState(self.sync_state_path)
+        self.compiler_cache: Optional[compiler_cache.CompilerCache] = None
+        if os.getenv("BBIN_NO_CACHE") != "1":
+            self.compiler_cache = compiler_cache.CompilerCache(self.cache_path)
 
-        if not (bbin_dir.exists() and bbin_dir.is_dir()):
+        if offline:  # Only what is needed to build and install packages
+            self.repo_path.mkdir(parents=True, exist_ok=True)
+        elif not bbin_dir.joinpath(".git").exists():
             interface.warn("Bbin's index is not initialized! Initalizing...")
-            git.clone(
-                BBIN_URL,
-                str(bbin_dir),
-                with_spinner=False,
-                success_text=f"Finished initializing bbin's index at {bbin_dir}",
-            )
+            self._initialize()
         else:
             self.update()
 
@@ -58,54 +77,248 @@ class Index:
         assert app_dir.exists() and app_dir.is_dir()
         assert binaries_dir.exists() and binaries_dir.is_dir()
 
+    def _initialize(self) -> None:
+        if not self._bbin_path.exists():
+            git.clone(
+                BBIN_URL,
+                str(self._bbin_path),
+                with_spinner=False,
+                success_text=f"Finished initializing bbin's index at {self._bbin_path}",
+            )
+            return
+        # An offline `sync` already put packages here, so clone next to them
+        with tempfile.TemporaryDirectory(dir=str(self._bbin_path)) as directory:
+            git.clone(
+                BBIN_URL,
+                directory,
+                with_spinner=False,
+                success_text=f"Finished initializing bbin's index at {self._bbin_path}",
+            )
+            for child in Path(directory).iterdir():
+                shutil.move(str(child), str(self._bbin_path))
+
     def update(self) -> None:
         git.pull(str(self._bbin_path), success_text="Updated index")
 
+    def read_json(self, path: Path) -> Any:  # type: ignore
+        """Parse a JSON file, reusing the last parse if it did not change"""
+        mtime = path.stat().st_mtime
+        cached = self._json_cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        parsed = json.loads(path.read_text())  # type: ignore
+        self._json_cache[path] = (mtime, parsed)
+        return parsed
+
     def get_url(self, package_name: str) -> Optional[str]:
-        found = json.loads(Path(self.index_path).read_text()).get(package_name)  # type: ignore
+        found = self.read_json(self.index_path).get(package_name)  # type: ignore
         assert found is None or isinstance(found, str)  # type: ignore
         return found
 
+    def search(self, query: str) -> List[str]:
+        query = query.lower()
+        packages: Dict[str, str] = self.read_json(self.index_path)  # type: ignore
+        return sorted(name for name in packages if query in name.lower())
+
+    def installed(self) -> List[str]:
+        if not self.repo_path.is_dir():
+            return []
+        return sorted(path.name for path in self.repo_path.iterdir() if path.is_dir())
+
+    def install_package(
+        self, package_name: str, action: Union[enums.InstallAction, str]
+    ) -> None:
+        url = self.get_url(package_name)
+        if url is None:
+            raise click.BadParameter("Invalid package name: package not found")
+        self.install(self.build(self.download(package_name, url)), action)
+
+    def install_packages(
+        self,
+        package_names: List[str],
+        action: Union[enums.InstallAction, str],
+        executor: Optional[Executor] = None,
+        jobs: Optional[int] = None,
+    ) -> None:
+        """Install many packages, starting the ones that took longest last time first"""
+        self._run_batch(
+            functools.partial(self.install_package, action=action),
+            self.history.schedule(package_names),
+            executor,
+            jobs,
+        )
+
+    def lock_package(self, package_name: str) -> lockfile.LockedPackage:
+        """Resolve a package to the exact commit and build instructions to use"""
+        url = self.get_url(package_name)
+        if url is None:
+            raise click.BadParameter(f"Invalid package name: {package_name} not found")
+        with tempfile.TemporaryDirectory() as directory:
+            git.clone(url, directory=directory)
+            try:
+                json_stuff = json.loads(Path(directory, "package.json").read_text())  # type: ignore
+                return lockfile.LockedPackage(
+                    name=package_name,
+                    url=url,
+                    commit=git.rev_parse(directory, json_stuff["version"]),  # type: ignore
+                    version=json_stuff["version"],  # type: ignore
+                    compiler=json_stuff["compiler"],  # type: ignore
+                    build=json_stuff["build"],  # type: ignore
+                    target=json_stuff["target"],  # type: ignore
+                    hashes=json_stuff["hashes"],  # type: ignore
+                )
+            except OSError as exception:
+                raise click.ClickException(
+                    f"The package.json does not exist for {package_name}. Please consult the maintainer"
+                ) from exception
+            except (KeyError, ValueError) as exception:
+                raise click.ClickException(
+                    f"The package.json of {package_name} is invalid. Please consult the maintainer"
+                ) from exception
+            except subprocess.CalledProcessError as exception:
+                raise click.ClickException(
+                    f"Could not resolve the version of {package_name}"
+                ) from exception
+
+    def sync_package(
+        self, package: lockfile.LockedPackage, action: Union[enums.InstallAction, str]
+    ) -> bool:
+        """Install a locked package unless a previous sync already installed it.
+
+        Returns whether anything was (re)installed.
+        """
+        installed = self._bin_path.joinpath(Path(package.target).name)
+        if self.sync_state.is_synced(package, installed):
+            return False
+        repository = self.repo_path.joinpath(package.name)
+        if repository.is_dir():
+            git.fetch(str(repository), package.url)
+        else:
+            self.download(package.name, package.url)
+        # Fetching and checking out only report failures, so make sure we
+        # are really building the pinned commit
+        git.checkout(str(repository), package.commit)
+        try:
+            head = git.rev_parse(str(repository))
+        except subprocess.CalledProcessError:
+            head = None
+        if head != package.commit:
+            raise click.ClickException(
+                f"Could not check out {package.name} at its pinned commit {package.commit}"
+            )
+        executable = self.build(repository, package.manifest())
+        if installed.exists() or installed.is_symlink():
+            installed.unlink()
+        self.install(executable, action)
+        self.sync_state.record(package, installed)
+        return True
+
+    def sync_packages(
+        self,
+        packages: List[lockfile.LockedPackage],
+        action: Union[enums.InstallAction, str],
+        executor: Optional[Executor] = None,
+        jobs: Optional[int] = None,
+    ) -> List[str]:
+        """Sync many locked packages. Returns the names of those that were (re)installed"""
+        by_name = {package.name: package for package in packages}
+        ordered = [by_name[name] for name in self.history.schedule(list(by_name))]
+        changed = self._run_batch(
+            functools.partial(self.sync_package, action=action), ordered, executor, jobs
+        )
+        return [package.name for package, was_changed in zip(ordered, changed) if was_changed]
+
+    def _run_batch(
+        self,
+        function: Callable[[Any], Any],  # type: ignore
+        items: List[Any],  # type: ignore
+        executor: Optional[Executor],
+        jobs: Optional[int],
+    ) -> List[Any]:  # type: ignore
+        """Call `function` on each item, in order, with at most `jobs` running at once"""
+        if executor is None:
+            return [function(item) for item in items]
+        results: List[Any] = [None] * len(items)  # type: ignore
+        queue = iter(enumerate(items))
+        running: Dict[Future, int] = {}  # type: ignore
+
+        def submit_next() -> None:
+            next_item = next(queue, None)
+            if next_item is not None:
+                position, item = next_item
+                running[executor.submit(self._in_context, function, item)] = position
+
+        for _ in range(jobs or len(items)):
+            submit_next()
+        while running:
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+                submit_next()
+        return results
+
+    @staticmethod
+    def _in_context(function: Callable[..., Any], *args: Any) -> Any:  # type: ignore
+        # `build` reports failures through the current click context,
+        # which is thread-local
+        with click.Context(click.Command("bbin")):
+            return function(*args)
+
     def download(self, package_name: str, url: str) -> Path:
         output = Path(self.repo_path).joinpath(package_name)
         if output.exists() and output.is_dir():
             raise click.ClickException("Error: package already installed")
-        git.clone(url, directory=str(output))
+        measurement = utils.Measurement()
+        git.clone(url, directory=str(output), measurement=measurement)
+        self.history.record(package_name, "clone", measurement)
         return output
 
-    def build(self, repository_path: Path) -> str:
+    def build(
+        self, repository_path: Path, json_stuff: Optional[Dict[str, Any]] = None  # type: ignore
+    ) -> str:
+        """Build a package, using its package.json unless given a (locked) one"""
         assert repository_path.exists() and repository_path.is_dir()
         try:  # TODO: Implement dependency resolution
             # TODO: Implement compiler bootstrap
-            package_json = repository_path.joinpath("package.json")
+            if json_stuff is None:
+                package_json = repository_path.joinpath("package.json")
 
-            json_stuff = json.loads(package_json.read_text())  # type: ignore
+                json_stuff = self.read_json(package_json)  # type: ignore
 
             git.checkout(str(repository_path), json_stuff["version"])  # type: ignore
 
-            build_script = json_to_obj.BuildInstructions(json_stuff["build"]).get()  # type: ignore
+            # Copy it, as the parsed package.json is cached
+            build_script = list(json_to_obj.BuildInstructions(json_stuff["build"]).get())  # type: ignore
             deps: List[Dict[str, str]] = json_stuff.get("deps", [])  # type: ignore
             assert isinstance(deps, list)
             compiler = dep_resolver.resolve_compiler(json_stuff["compiler"])  # type: ignore
             build_script.insert(0, compiler)
             check_sum = json_to_obj.Hashes(json_stuff["hashes"]).get()  # type: ignore
 
-            outcome = utils.run_subprocess(
-                build_script,
-                loading_text=f"Building (script: {' '.join(build_script)})",
-                fail_text="Build failed!",
-                success_text="Build succeeded!",
-                text_color="yellow",
-                spinner_color="cyan",
-                stderr=subprocess.STDOUT,
-                cwd=str(repository_path),
-            )
+            target_exe = Path(repository_path.joinpath(json_stuff["target"]))  # type: ignore
             ctx = click.get_current_context()
+            measurement = utils.Measurement()
+            with contextlib.ExitStack() as stack:
+                if self.compiler_cache is not None:
+                    build_script = self._compile(
+                        stack, self.compiler_cache, build_script, repository_path, measurement
+                    )
+                outcome = utils.run_subprocess(
+                    build_script,
+                    loading_text=f"Building (script: {' '.join(build_script)})",
+                    fail_text="Build failed!",
+                    success_text="Build succeeded!",
+                    text_color="yellow",
+                    spinner_color="cyan",
+                    measurement=measurement,
+                    stderr=subprocess.STDOUT,
+                    cwd=str(repository_path),
+                )
             if outcome is not None:
                 log_path = self.create_build_log(outcome.stdout.decode())  # type: ignore
                 ctx.fail(f"See the build log at {log_path}")
+            self.history.record(repository_path.name, "build", measurement)
 
-            target_exe = Path(repository_path.joinpath(json_stuff["target"]))  # type: ignore
             if not utils.is_an_executable(target_exe):
                 ctx.fail("Could not find target executable!")
             with halo.Halo("Checking hash") as spinner:  # type: ignore
@@ -124,7 +337,35 @@ class Index:
                 "The package.json is invalid. Please consult the maintainer"
             ) from exception
 
+    def _compile(
+        self,
+        stack: contextlib.ExitStack,
+        cache: compiler_cache.CompilerCache,
+        build_script: List[str],
+        repository_path: Path,
+        measurement: utils.Measurement,
+    ) -> List[str]:
+        """Compile the sources through the cache, returning the script that links them"""
+        with halo.Halo("Compiling (with the compiler cache)", text_color="yellow", color="cyan") as spinner:  # type: ignore
+            try:
+                compiled = stack.enter_context(
+                    cache.compile(build_script, repository_path, measurement)
+                )
+            except subprocess.CalledProcessError as exception:
+                spinner.fail("Build failed!")  # type: ignore
+                log_path = self.create_build_log((exception.output or b"").decode())
+                click.get_current_context().fail(f"See the build log at {log_path}")
+            if compiled.sources:
+                spinner.succeed(  # type: ignore
+                    f"Compiled {compiled.sources} source{'s' if compiled.sources > 1 else ''}"
+                    f" ({compiled.hits} from the compiler cache)"
+                )
+            else:
+                spinner.info("This build script can't use the compiler cache")  # type: ignore
+        return compiled.link_script
+
     def create_build_log(self, contents: str, prefix: Optional[str] = None) -> str:
+        self.build_log_path.mkdir(parents=True, exist_ok=True)
         build_log = tempfile.mkstemp(
             prefix=prefix, suffix="log", dir=self.build_log_path, text=True
         )[-1]
@@ -173,3 +414,15 @@ class Index:
     @property
     def build_log_path(self) -> Path:
         return self._bbin_path.joinpath("build_logs")
+
+    @property
+    def cache_path(self) -> Path:
+        return self._bbin_path.joinpath(compiler_cache.DIRECTORY_NAME)
+
+    @property
+    def sync_state_path(self) -> Path:
+        return self._bbin_path.joinpath(lockfile.STATE_FILE_NAME)
+
+    @property
+    def history_path(self) -> Path:
+        return self._bbin_path.joinpath(history.FILE_NAME)
@@ -0,0 +1,365 @@
+"""Cache compiled objects, like ccache
+
+Packages are built by a single compiler invocation that compiles and links
+at once, which ccache won't cache. So we split it up: each source is
+compiled on its own (`-c`) into an object, which is cached by the compiler's
+identity, the compile flags, and the *preprocessed* source. Then the objects
+are linked by the original command, which is never cached, so upgraded
+libraries are always linked in.
+"""
+import contextlib
+import functools
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import click
+
+from . import utils
+
+# Bump this whenever the way keys are computed changes
+KEY_VERSION = "2"
+SOURCE_SUFFIXES = {".c", ".cc", ".cpp", ".cxx", ".c++", ".C", ".m", ".mm"}
+# Flags whose value is the next argument
+ARGUMENT_FLAGS = {
+    "-o",
+    "-I",
+    "-D",
+    "-U",
+    "-include",
+    "-imacros",
+    "-isystem",
+    "-iquote",
+    "-idirafter",
+    "-L",
+    "-l",
+    "-Xlinker",
+    "-u",
+    "-T",
+    "-framework",
+}
+# Flags that only matter when linking, so they don't go into the compile step
+LINK_FLAGS = {
+    "-o",
+    "-Xlinker",
+    "-u",
+    "-T",
+    "-framework",
+    "-static",
+    "-shared",
+    "-rdynamic",
+    "-pie",
+    "-no-pie",
+    "-nostdlib",
+    "-nodefaultlibs",
+    "-nostartfiles",
+    "-s",
+}
+LINK_FLAG_PREFIXES = ("-l", "-L", "-Wl,")
+# Flags that mean the build script isn't a plain "compile and link"
+UNSPLITTABLE_FLAGS = {
+    "-c",
+    "-S",
+    "-E",
+    "-M",
+    "-MM",
+    "-MD",
+    "-MMD",
+    "-MF",
+    "-MT",
+    "-MQ",
+    "-MP",
+    "-save-temps",
+}
+DIRECTORY_NAME = "compiler_cache"
+MAX_SIZE = os.getenv("BBIN_CACHE_SIZE", "1G")
+_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+# Shared by every `CompilerCache`, as each build makes its own
+_LOCK = threading.Lock()
+
+
+class Stats(NamedTuple):
+    hits: int
+    misses: int
+    uncacheable: int
+    entries: int
+    size: int
+    max_size: int
+
+    @property
+    def hit_rate(self) -> Optional[float]:
+        total = self.hits + self.misses
+        return self.hits / total if total else None
+
+
+class Compiled(NamedTuple):
+    link_script: List[str]  # The build script, with objects instead of sources
+    sources: int  # 0 if the build script couldn't be split up
+    hits: int
+
+
+def parse_size(size: str) -> int:
+    """Parse a size like `500M` or `2G` into bytes"""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*", size, re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Invalid size: {size!r}")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()])
+
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+@functools.lru_cache(maxsize=None)
+def _hash_file(path: str, mtime: float, size: int) -> str:
+    # `mtime` and `size` are only here to invalidate the cache
+    # pylint: disable=unused-argument
+    return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+
+
+def compiler_identity(compiler: str) -> str:
+    """Identify a compiler by the contents of its executable"""
+    path = os.path.realpath(compiler)
+    stat = os.stat(path)
+    return _hash_file(path, stat.st_mtime, stat.st_size)
+
+
+def split_build_script(args: List[str], cwd: Path) -> Optional[Tuple[List[str], List[int]]]:
+    """Find the compile flags and where the sources are in a build script's arguments.
+
+    Returns `None` if the build script can't be split into compiling and linking.
+    """
+    compile_flags: List[str] = []
+    sources: List[int] = []
+    position = 0
+    while position < len(args):
+        arg = args[position]
+        if arg in UNSPLITTABLE_FLAGS or arg.startswith(("-x", "@")):
+            return None
+        flag = args[position : position + 2] if arg in ARGUMENT_FLAGS else [arg]
+        if arg.startswith("-"):
+            if not (arg in LINK_FLAGS or arg.startswith(LINK_FLAG_PREFIXES)):
+                compile_flags.extend(flag)
+        elif Path(arg).suffix in SOURCE_SUFFIXES and cwd.joinpath(arg).is_file():
+            sources.append(position)
+        # Anything else (objects, libraries) is only needed when linking
+        position += len(flag)
+    if not sources:
+        return None
+    return compile_flags, sources
+
+
+class CompilerCache:
+    """An on-disk, size-limited cache of compiled objects"""
+
+    def __init__(self, path: Path, max_size: str = MAX_SIZE) -> None:
+        # Compilers run in the package's directory, so objects need absolute paths
+        self._path = Path(os.path.abspath(str(path)))
+        self._max_size = max_size
+
+    @property
+    def max_size(self) -> int:
+        """The size limit in bytes. Only checked once the cache is actually used"""
+        try:
+            return parse_size(self._max_size)
+        except ValueError as exception:
+            raise click.ClickException(
+                f"Invalid compiler cache size {self._max_size!r} (see BBIN_CACHE_SIZE)"
+            ) from exception
+
+    @property
+    def stats_path(self) -> Path:
+        return self._path.joinpath("stats.json")
+
+    @property
+    def objects_path(self) -> Path:
+        return self._path.joinpath("objects")
+
+    @contextlib.contextmanager
+    def compile(
+        self, build_script: List[str], cwd: Path, measurement: utils.Measurement
+    ) -> Iterator[Compiled]:
+        """Compile each source through the cache, yielding the command that links them.
+
+        The objects only live until the context exits. If the build script
+        can't be split up, it is yielded unchanged.
+        Raises `subprocess.CalledProcessError` if a source fails to compile.
+        """
+        max_size = self.max_size  # Fail before compiling anything
+        compiler, *args = build_script
+        split = split_build_script(args, cwd)
+        try:
+            identity: Optional[str] = compiler_identity(compiler)
+        except (OSError, TypeError):  # The compiler couldn't be resolved
+            identity = None
+        if split is None or identity is None:
+            self._count("uncacheable")
+            yield Compiled(build_script, 0, 0)
+            return
+
+        compile_flags, sources = split
+        self._path.mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory(prefix="build-", dir=str(self._path)) as objects:
+            link_script = list(build_script)
+            hits = 0
+            for number, position in enumerate(sources):
+                source = args[position]
+                object_path = Path(objects, f"{number}-{Path(source).stem}.o")
+                if self._compile(
+                    [compiler, *compile_flags], identity, source, object_path, cwd, measurement
+                ):
+                    hits += 1
+                link_script[position + 1] = str(object_path)
+            self.evict(max_size)
+            yield Compiled(link_script, len(sources), hits)
+
+    def _compile(
+        self,
+        compile_command: List[str],
+        identity: str,
+        source: str,
+        object_path: Path,
+        cwd: Path,
+        measurement: utils.Measurement,
+    ) -> bool:
+        """Compile a source into `object_path`. Returns whether it came from the cache"""
+        key = self._key(compile_command, identity, source, cwd, measurement)
+        if key is not None and self._restore(key, object_path):
+            self._count("hits")
+            return True
+        self._count("misses" if key is not None else "uncacheable")
+        utils.run_measured(
+            [*compile_command, "-c", source, "-o", str(object_path)],
+            measurement,
+            cwd=str(cwd),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        if key is not None:
+            self._store(key, object_path)
+        return False
+
+    def _key(
+        self,
+        compile_command: List[str],
+        identity: str,
+        source: str,
+        cwd: Path,
+        measurement: utils.Measurement,
+    ) -> Optional[str]:
+        # Preprocessing pulls in every header. The source is passed as given
+        # (relative to the package) so that line markers, and therefore keys,
+        # are the same for the same sources in different packages.
+        try:
+            preprocessed = utils.run_measured(
+                [*compile_command, "-E", source],
+                measurement,
+                cwd=str(cwd),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            ).stdout
+        except subprocess.CalledProcessError:
+            return None  # Let compiling it report the error
+        digest = hashlib.sha256()
+        digest.update(KEY_VERSION.encode())
+        digest.update(identity.encode())
+        digest.update(json.dumps(compile_command[1:]).encode())
+        digest.update(Path(source).suffix.encode())  # It decides the language
+        digest.update(preprocessed)
+        return digest.hexdigest()
+
+    def _entry(self, key: str) -> Path:
+        return self.objects_path.joinpath(key[:2], key)
+
+    def _restore(self, key: str, destination: Path) -> bool:
+        entry = self._entry(key)
+        try:
+            shutil.copyfile(str(entry), str(destination))
+        except OSError:
+            return False
+        os.utime(str(entry))  # Evict the least recently used entries first
+        return True
+
+    def _store(self, key: str, source: Path) -> None:
+        entry = self._entry(key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        # Copy then rename, so concurrent builds never see half an entry
+        file_descriptor, temporary = tempfile.mkstemp(dir=str(entry.parent), suffix=".tmp")
+        os.close(file_descriptor)
+        shutil.copyfile(str(source), temporary)
+        os.replace(temporary, str(entry))
+
+    def _entries(self) -> List[Tuple[Path, os.stat_result]]:
+        """Every entry with its `stat`, skipping those another process just evicted"""
+        if not self.objects_path.is_dir():
+            return []
+        entries = []
+        for path in self.objects_path.glob("*/*"):
+            if path.suffix == ".tmp" or not path.is_file():
+                continue
+            try:
+                entries.append((path, path.stat()))
+            except FileNotFoundError:
+                continue
+        return entries
+
+    def evict(self, max_size: Optional[int] = None) -> None:
+        if max_size is None:
+            max_size = self.max_size
+        # `_LOCK` doesn't stop other bbin processes from evicting too
+        with _LOCK:
+            entries = sorted(self._entries(), key=lambda entry: entry[1].st_mtime)
+            size = sum(stat.st_size for _, stat in entries)
+            while entries and size > max_size:
+                oldest, stat = entries.pop(0)
+                size -= stat.st_size
+                try:
+                    oldest.unlink()
+                except FileNotFoundError:
+                    pass
+
+    def clear(self) -> None:
+        with _LOCK:
+            if self._path.is_dir():
+                shutil.rmtree(str(self._path))
+
+    def _load_counters(self) -> Dict[str, int]:
+        try:
+            return json.loads(self.stats_path.read_text())  # type: ignore
+        except (OSError, ValueError):
+            return {}
+
+    def _count(self, counter: str) -> None:
+        with _LOCK:
+            counters = self._load_counters()
+            counters[counter] = counters.get(counter, 0) + 1
+            self._path.mkdir(parents=True, exist_ok=True)
+            file_descriptor, temporary = tempfile.mkstemp(
+                dir=str(self._path), suffix=".tmp"
+            )
+            with os.fdopen(file_descriptor, "w") as file:
+                json.dump(counters, file)
+            os.replace(temporary, str(self.stats_path))
+
+    def stats(self) -> Stats:
+        counters = self._load_counters()
+        entries = self._entries()
+        return Stats(
+            hits=counters.get("hits", 0),
+            misses=counters.get("misses", 0),
+            uncacheable=counters.get("uncacheable", 0),
+            entries=len(entries),
+            size=sum(stat.st_size for _, stat in entries),
+            max_size=self.max_size,
+        )
@@ -0,0 +1,234 @@
+"""A resident daemon (`bbind`) that keeps bbin's index warm
+
+The daemon serves newline-delimited JSON requests over a Unix domain socket.
+Each request looks like `{"command": ..., "arguments": {...}}` and gets a
+single `{"ok": ..., "result": ...}` (or `{"ok": false, "error": ...}`) reply.
+"""
+import json
+import os
+import os.path
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import click
+
+from . import bbin, dep_resolver, interface
+
+SOCKET_PATH = os.getenv("BBIN_SOCKET", os.path.expanduser("~/.cache/bbin/bbind.sock"))
+# Environment variables that change how packages are built
+BUILD_ENVIRONMENT = ("PATH", "BBIN_NO_CACHE", "BBIN_CACHE_SIZE", "BBIN_GIT_CALLBACK")
+
+
+def build_environment() -> Dict[str, Optional[str]]:
+    return {name: os.getenv(name) for name in BUILD_ENVIRONMENT}
+
+
+class Daemon:
+    """Warm state shared by every connection"""
+
+    def __init__(self, workers: int = 1, refresh_interval: float = 300.0) -> None:
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._refresh_interval = refresh_interval
+        # Only guards the dictionaries below; never held during network I/O
+        self._lock = threading.Lock()
+        # (bbin_path, bin_path, app_path) -> (index, time of the last `git pull`)
+        self._indexes: Dict[Tuple[str, str, str], Tuple[bbin.Index, float]] = {}
+        # Held while an index is being cloned or pulled
+        self._index_locks: Dict[Tuple[str, str, str], threading.Lock] = {}
+
+    def get_index(self, bbin_path: str, bin_path: str, app_path: str) -> bbin.Index:
+        """Get a warm index, pulling it only if it has gone stale"""
+        key = (bbin_path, bin_path, app_path)
+        with self._lock:
+            index_lock = self._index_locks.setdefault(key, threading.Lock())
+            entry = self._indexes.get(key)
+
+        if entry is None:
+            with index_lock:
+                with self._lock:  # Someone else may have created it meanwhile
+                    entry = self._indexes.get(key)
+                if entry is None:
+                    entry = (
+                        bbin.Index(bbin_path=bbin_path, bin_path=bin_path, app_path=app_path),
+                        time.monotonic(),
+                    )
+                    with self._lock:
+                        self._indexes[key] = entry
+            return entry[0]
+
+        index, last_update = entry
+        # If another request is already pulling, serve the index we have
+        if time.monotonic() - last_update >= self._refresh_interval and index_lock.acquire(
+            blocking=False
+        ):
+            try:
+                with self._lock:
+                    _, last_update = self._indexes[key]
+                if time.monotonic() - last_update >= self._refresh_interval:
+                    index.update()
+                    dep_resolver.which.cache_clear()
+                    with self._lock:
+                        self._indexes[key] = (index, time.monotonic())
+            finally:
+                index_lock.release()
+        return index
+
+    def handle(self, message: Dict[str, Any]) -> Dict[str, Any]:  # type: ignore
+        """Run a request and build its reply"""
+        try:
+            command = message["command"]
+            arguments: Dict[str, Any] = message.get("arguments", {})  # type: ignore
+            if command == "install" and arguments.get("environment") != build_environment():
+                # We would build with our environment, not the client's
+                return {
+                    "ok": False,
+                    "fallback": True,
+                    "error": "The daemon's build environment differs from the client's",
+                }
+            index = self.get_index(
+                arguments["bbin_path"], arguments["bin_path"], arguments["app_path"]
+            )
+            if command == "install":
+                result: Any = self.install(  # type: ignore
+                    index,
+                    arguments["packages"],
+                    arguments["action"],
+                    arguments.get("jobs"),
+                )
+            elif command == "search":
+                result = index.search(arguments["query"])
+            elif command == "list":
+                result = index.installed()
+            else:
+                return {"ok": False, "error": f"Unknown command: {command!r}"}
+        except click.ClickException as exception:
+            return {"ok": False, "error": exception.format_message()}
+        except KeyError as exception:
+            return {"ok": False, "error": f"Malformed request: missing {exception}"}
+        except Exception as exception:  # pylint: disable=broad-except
+            # Keep serving other clients no matter what went wrong
+            return {"ok": False, "error": f"{type(exception).__name__}: {exception}"}
+        return {"ok": True, "result": result}
+
+    def install(
+        self,
+        index: bbin.Index,
+        packages: List[str],
+        action: str,
+        jobs: Optional[int] = None,
+    ) -> List[str]:
+        """Install packages on the worker pool, at most `jobs` at a time"""
+        index.install_packages(packages, action, executor=self._pool, jobs=jobs)
+        return packages
+
+    def shutdown(self) -> None:
+        self._pool.shutdown()
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):  # type: ignore
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, state: Daemon) -> None:
+        self.state = state
+        super().__init__(socket_path, _Handler)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        line = self.rfile.readline()
+        if not line:  # Only probing whether we are alive
+            return
+        try:
+            message = json.loads(line)
+        except ValueError:
+            response = {"ok": False, "error": "Malformed request"}
+        else:
+            response = self.server.state.handle(message)  # type: ignore
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+def is_running(socket_path: str = SOCKET_PATH) -> bool:
+    """Check if a daemon is listening on the socket"""
+    if not hasattr(socket, "AF_UNIX"):
+        return False
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:  # type: ignore
+        try:
+            connection.connect(socket_path)
+        except OSError:
+            return False
+    return True
+
+
+def request(  # type: ignore
+    command: str, socket_path: str = SOCKET_PATH, **arguments: Any
+) -> Optional[Any]:
+    """Send a request to the daemon
+
+    Returns `None` if there is no daemon to serve it (or it won't, e.g.
+    because it would build with a different environment), in which case
+    the caller should do the work in-process.
+    """
+    if os.getenv("BBIN_NO_DAEMON") == "1" or not hasattr(socket, "AF_UNIX"):
+        return None
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:  # type: ignore
+        try:
+            connection.connect(socket_path)
+        except OSError:
+            return None
+        connection.sendall(
+            json.dumps({"command": command, "arguments": arguments}).encode() + b"\n"
+        )
+        with connection.makefile("rb") as reply:
+            response = reply.readline()
+    if not response:
+        raise click.ClickException("The daemon closed the connection unexpectedly")
+    response = json.loads(response)
+    if response.get("fallback"):
+        return None
+    if not response["ok"]:
+        raise click.ClickException(response["error"])
+    return response["result"]
+
+
+@click.command()
+@click.option("--socket", "socket_path", default=SOCKET_PATH)
+@click.option("--workers", default=lambda: os.cpu_count() or 1, type=click.IntRange(1))
+@click.option(
+    "--refresh-interval",
+    default=300.0,
+    type=float,
+    help="Seconds between `git pull`s of the index",
+)
+def main(socket_path: str, workers: int, refresh_interval: float) -> None:
+    """Serve bbin requests from a warm index"""
+    if not hasattr(socket, "AF_UNIX"):
+        raise click.ClickException("Unix domain sockets are not supported on this platform")
+    if is_running(socket_path):
+        raise click.ClickException(f"A daemon is already listening on {socket_path}")
+    path = Path(socket_path)
+    if path.exists():  # Left behind by a daemon that did not shut down cleanly
+        path.unlink()
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    state = Daemon(workers=workers, refresh_interval=refresh_interval)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    with _Server(socket_path, state) as server:
+        interface.info(f"Listening on {socket_path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            state.shutdown()
+            path.unlink()
+
+
+if __name__ == "__main__":
+    main()
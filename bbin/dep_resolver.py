@@ -1,6 +1,7 @@
 """Resolve dependencies"""
+import functools
 import shutil
-from typing import Dict, List, Union
+from typing import Dict, List, Optional, Union
 
 COMPILER_MAP = {"cpp": ["clang++", "g++"], "c": ["clang", "gcc"]}
 
@@ -22,6 +23,12 @@ def resolve_exe(exe_names: List[str]) -> str:
     """Resolve executable (from a list of names) for the system"""
     output = None
     for name in exe_names:
-        output = shutil.which(name)
+        output = which(name)
         if output is not None:
             return output
+
+
+@functools.lru_cache(maxsize=None)
+def which(name: str) -> Optional[str]:
+    """A cached `shutil.which`. Call `which.cache_clear()` to pick up new executables"""
+    return shutil.which(name)
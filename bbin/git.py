@@ -1,5 +1,6 @@
 """Git interaction"""
 import shutil
+import subprocess
 from os import getenv
 from pathlib import Path
 from typing import Any, Optional
@@ -53,6 +54,33 @@ def pull(
     )
 
 
+def fetch(
+    repo: str,
+    remote: Optional[str] = None,
+    silent: bool = True,
+    with_spinner: bool = False,
+    **kwargs: Any,  # type: ignore
+) -> None:
+    """Fetch every branch and tag of a repository (or of another `remote` URL)"""
+    args = [GIT, "-C", repo, "fetch", "--tags"]
+    if remote is not None:
+        # Keep the branches apart from the clone's own remote-tracking ones
+        args.extend([remote, "+refs/heads/*:refs/bbin/heads/*"])
+    if silent:
+        args.append("--quiet")
+    utils.run_subprocess(
+        args, loading_text=f"Fetching {remote or repo}", with_spinner=with_spinner, **kwargs
+    )
+
+
+def rev_parse(repo: str, ref: str = "HEAD") -> str:
+    """Get the commit a reference points to"""
+    args = [GIT, "-C", repo, "rev-parse", f"{ref}^{{commit}}"]
+    return subprocess.run(  # type: ignore
+        args, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    ).stdout.decode().strip()
+
+
 def checkout(
     repo: str, tag: str, silent: bool = True, with_spinner: bool = False
 ) -> None:
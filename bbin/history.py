@@ -0,0 +1,102 @@
+"""Remember how long each package took to download and build"""
+import heapq
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from . import utils
+
+FILE_NAME = "history.json"
+# How many runs of each phase to remember
+KEEP = 10
+
+
+class Estimate(NamedTuple):
+    package_name: str
+    seconds: Optional[float]  # `None` if the package was never built here
+    max_rss: Optional[int]
+
+
+class Plan(NamedTuple):
+    estimates: List[Estimate]  # In the order they should be started
+    wall_time: float
+
+
+class History:
+    """A JSON store of per-package phase durations and resource peaks"""
+
+    def __init__(self, path: Path) -> None:
+        self._path = path
+        self._lock = threading.Lock()
+
+    def load(self) -> Dict[str, Dict[str, List[Dict[str, Any]]]]:  # type: ignore
+        try:
+            return json.loads(self._path.read_text())  # type: ignore
+        except (OSError, ValueError):
+            return {}
+
+    def record(
+        self, package_name: str, phase: str, measurement: utils.Measurement
+    ) -> None:
+        """Remember a run of a phase (e.g. `clone` or `build`)"""
+        with self._lock:
+            data = self.load()
+            runs = data.setdefault(package_name, {}).setdefault(phase, [])
+            runs.append(dict(measurement.as_dict(), time=time.time()))
+            del runs[:-KEEP]
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            # Write atomically so a crash never leaves a truncated history
+            file_descriptor, temporary = tempfile.mkstemp(
+                dir=str(self._path.parent), suffix=".tmp"
+            )
+            with os.fdopen(file_descriptor, "w") as file:
+                json.dump(data, file)
+            os.replace(temporary, str(self._path))
+
+    def estimate(self, package_name: str) -> Estimate:
+        """Estimate how long a package takes using the mean of each phase's runs"""
+        phases = self.load().get(package_name)
+        if not phases:
+            return Estimate(package_name, None, None)
+        seconds = 0.0
+        peaks = []
+        for runs in phases.values():
+            seconds += sum(run["wall"] for run in runs) / len(runs)
+            peaks.extend(run["max_rss"] for run in runs if run.get("max_rss"))
+        return Estimate(package_name, seconds, max(peaks) if peaks else None)
+
+    def plan(self, package_names: List[str], jobs: int = 1) -> Plan:
+        """Order packages longest-first and predict the total wall time.
+
+        With independent packages, the critical path is simply the longest
+        build, so starting the longest ones first keeps it off the tail.
+        Packages without any history are assumed to take the average time.
+        """
+        estimates = [self.estimate(package_name) for package_name in package_names]
+        known = [estimate.seconds for estimate in estimates if estimate.seconds is not None]
+        average = sum(known) / len(known) if known else 0.0
+
+        def expected(estimate: Estimate) -> float:
+            return average if estimate.seconds is None else estimate.seconds
+
+        # `sorted` is stable, so packages we know nothing about keep their order
+        ordered = sorted(estimates, key=expected, reverse=True)
+        workers = [0.0] * max(1, jobs)
+        for estimate in ordered:
+            heapq.heappush(workers, heapq.heappop(workers) + expected(estimate))
+        return Plan(ordered, max(workers))
+
+    def schedule(self, package_names: List[str]) -> List[str]:
+        """Get the order packages should be started in"""
+        return [estimate.package_name for estimate in self.plan(package_names).estimates]
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(seconds, 60)
+    if minutes:
+        return f"{int(minutes)}m {seconds:04.1f}s"
+    return f"{seconds:.1f}s"
@@ -0,0 +1,123 @@
+"""Lockfiles, for installing the exact same packages everywhere"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple
+
+import click
+
+FILE_NAME = "bbin.lock"
+STATE_FILE_NAME = "sync.json"
+VERSION = 1
+
+
+class LockedPackage(NamedTuple):
+    """Everything needed to build a package without the index"""
+
+    name: str
+    url: str
+    commit: str
+    version: str  # The tag `commit` was resolved from
+    compiler: Dict[str, Any]  # type: ignore
+    build: Dict[str, Dict[str, List[str]]]
+    target: str
+    hashes: Dict[str, Dict[str, str]]
+
+    def manifest(self) -> Dict[str, Any]:  # type: ignore
+        """Get a `package.json` that builds the pinned commit"""
+        return {
+            "version": self.commit,
+            "build": self.build,
+            "compiler": self.compiler,
+            "target": self.target,
+            "hashes": self.hashes,
+        }
+
+    def fingerprint(self) -> str:
+        """Hash everything pinned about this package"""
+        return hashlib.sha256(
+            json.dumps(self._asdict(), sort_keys=True).encode()
+        ).hexdigest()
+
+
+def load(path: Path) -> Dict[str, LockedPackage]:
+    try:
+        data = json.loads(path.read_text())  # type: ignore
+    except OSError as exception:
+        raise click.ClickException(f"Could not read the lockfile at {path}") from exception
+    except ValueError as exception:
+        raise click.ClickException(f"The lockfile at {path} is not valid JSON") from exception
+    if not isinstance(data, dict) or data.get("version") != VERSION:
+        raise click.ClickException(
+            f"The lockfile at {path} is not a version {VERSION} bbin lockfile"
+        )
+    try:
+        return {
+            name: LockedPackage(name=name, **package)  # type: ignore
+            for name, package in data["packages"].items()  # type: ignore
+        }
+    except (KeyError, TypeError, AttributeError) as exception:
+        raise click.ClickException(f"The lockfile at {path} is invalid") from exception
+
+
+def dump(packages: List[LockedPackage], path: Path) -> None:
+    data = {
+        "version": VERSION,
+        "packages": {
+            package.name: {
+                field: value
+                for field, value in package._asdict().items()
+                if field != "name"
+            }
+            for package in sorted(packages, key=lambda package: package.name)
+        },
+    }
+    path.write_text(json.dumps(data, indent=4) + "\n")
+
+
+class SyncState:
+    """What `bbin sync` installed, so unchanged packages can be skipped
+
+    The maintainer's hashes rarely match a binary built by another
+    toolchain, so we compare against what we built ourselves instead.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self._path = path
+        self._lock = threading.Lock()
+
+    def load(self) -> Dict[str, Dict[str, str]]:
+        try:
+            return json.loads(self._path.read_text())  # type: ignore
+        except (OSError, ValueError):
+            return {}
+
+    def is_synced(self, package: LockedPackage, installed: Path) -> bool:
+        """Check if `installed` is still what we built for this exact lock entry"""
+        record = self.load().get(package.name)
+        if record is None or record.get("fingerprint") != package.fingerprint():
+            return False
+        try:
+            digest = hashlib.sha256(installed.read_bytes()).hexdigest()
+        except OSError:
+            return False
+        return digest == record.get("digest")
+
+    def record(self, package: LockedPackage, installed: Path) -> None:
+        with self._lock:
+            data = self.load()
+            data[package.name] = {
+                "commit": package.commit,
+                "fingerprint": package.fingerprint(),
+                "digest": hashlib.sha256(installed.read_bytes()).hexdigest(),
+            }
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            file_descriptor, temporary = tempfile.mkstemp(
+                dir=str(self._path.parent), suffix=".tmp"
+            )
+            with os.fdopen(file_descriptor, "w") as file:
+                json.dump(data, file)
+            os.replace(temporary, str(self._path))
@@ -3,6 +3,8 @@
 import hashlib
 import os
 import subprocess
+import sys
+import time
 from pathlib import Path
 from typing import Any, Dict, List, Optional
 
@@ -21,12 +23,19 @@ def run_subprocess(
     with_spinner: bool = True,
     spinner_color: Optional[str] = None,
     text_color: Optional[str] = None,
+    measurement: Optional["Measurement"] = None,
     **kwargs: Any
 ) -> Optional[subprocess.CalledProcessError]:
-    """Run a subprocess with a spinner."""
+    """Run a subprocess with a spinner.
+
+    If given a `measurement`, the resources the subprocess used are added to it.
+    """
     with halo.Halo(text=loading_text, enabled=with_spinner, color=spinner_color, text_color=text_color) as spinner:  # type: ignore
         try:
-            subprocess.run(args, check=True, **kwargs)  # type: ignore
+            if measurement is None:
+                subprocess.run(args, check=True, **kwargs)  # type: ignore
+            else:
+                run_measured(args, measurement, **kwargs)
         except subprocess.CalledProcessError as exception:
             spinner.fail(fail_text)  # type: ignore
             return exception
@@ -37,3 +46,47 @@ def run_subprocess(
 
 def is_an_executable(path: Path) -> bool:
     return path.is_file() and os.access(path, os.F_OK | os.X_OK)
+
+
+class Measurement:
+    """Resources used by one or more subprocesses"""
+
+    def __init__(self) -> None:
+        self.wall: float = 0.0
+        self.cpu: Optional[float] = None
+        self.max_rss: Optional[int] = None  # In KiB
+
+    def as_dict(self) -> Dict[str, Any]:  # type: ignore
+        return {"wall": self.wall, "cpu": self.cpu, "max_rss": self.max_rss}
+
+
+def _exit_code(status: int) -> int:
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def run_measured(
+    args: List[str], measurement: Measurement, **kwargs: Any  # type: ignore
+) -> "subprocess.CompletedProcess[bytes]":
+    """Like `subprocess.run(check=True)`, but adds what the process used to `measurement`.
+
+    The CPU time and peak memory are those of this process (and its own
+    children) only, as reported by `os.wait4`. Only `stdout` may be piped.
+    """
+    start = time.monotonic()
+    with subprocess.Popen(args, **kwargs) as process:  # type: ignore
+        stdout = process.stdout.read() if process.stdout is not None else None
+        if hasattr(os, "wait4"):
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = _exit_code(status)
+            measurement.cpu = (measurement.cpu or 0.0) + usage.ru_utime + usage.ru_stime
+            # macOS reports bytes; everything else reports KiB
+            max_rss = usage.ru_maxrss // (1024 if sys.platform == "darwin" else 1)
+            measurement.max_rss = max(measurement.max_rss or 0, max_rss)
+        else:  # Windows
+            process.wait()
+    measurement.wall += time.monotonic() - start
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, args, output=stdout)
+    return subprocess.CompletedProcess(args, process.returncode, stdout)
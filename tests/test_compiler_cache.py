@@ -0,0 +1,144 @@
+import os
+import shutil
+import subprocess
+from pathlib import Path
+
+import click
+import pytest
+
+from bbin import compiler_cache, utils
+
+COMPILER = shutil.which("cc") or shutil.which("gcc") or shutil.which("clang")
+needs_compiler = pytest.mark.skipif(COMPILER is None, reason="no C compiler")
+
+
+def test_parse_size():
+    assert compiler_cache.parse_size("500") == 500
+    assert compiler_cache.parse_size("2K") == 2048
+    assert compiler_cache.parse_size("1.5GiB") == 3 * 1024 ** 3 // 2
+    with pytest.raises(ValueError):
+        compiler_cache.parse_size("lots")
+
+
+def test_split_build_script(tmp_path):
+    tmp_path.joinpath("main.c").touch()
+    tmp_path.joinpath("util.c").touch()
+    args = ["-O2", "-I", "include", "-o", "hello", "main.c", "util.c", "-lm", "-L", "lib"]
+    assert compiler_cache.split_build_script(args, tmp_path) == (
+        ["-O2", "-I", "include"],
+        [5, 6],
+    )
+    # Already split up, or nothing to compile
+    assert compiler_cache.split_build_script(["-c", "main.c"], tmp_path) is None
+    assert compiler_cache.split_build_script(["-o", "hello", "main.o"], tmp_path) is None
+
+
+def _package(path, **sources):
+    path.mkdir()
+    for name, source in sources.items():
+        path.joinpath(name + ".c").write_text(source)
+    return path
+
+
+def _build(cache, path, target="hello"):
+    sources = sorted(source.name for source in path.glob("*.c"))
+    build_script = [COMPILER, "-O1", "-o", target, *sources]
+    with cache.compile(build_script, path, utils.Measurement()) as compiled:
+        subprocess.run(compiled.link_script, cwd=str(path), check=True)
+    assert subprocess.run(
+        [str(path / target)], stdout=subprocess.PIPE, check=True
+    ).stdout
+    return compiled
+
+
+MAIN = '#include <stdio.h>\nint answer(void);\nint main(void){printf("%d\\n", answer());}\n'
+
+
+@needs_compiler
+def test_only_changed_sources_are_recompiled(tmp_path):
+    cache = compiler_cache.CompilerCache(tmp_path / "cache")
+    package = _package(tmp_path / "package", main=MAIN, answer="int answer(void){return 1;}")
+
+    assert _build(cache, package).hits == 0
+    package.joinpath("answer.c").write_text("int answer(void){return 42;}")
+    compiled = _build(cache, package)
+    assert (compiled.sources, compiled.hits) == (2, 1)
+    assert subprocess.run([str(package / "hello")], stdout=subprocess.PIPE).stdout == b"42\n"
+
+    stats = cache.stats()
+    assert (stats.hits, stats.misses, stats.entries) == (1, 3, 3)
+
+
+@needs_compiler
+def test_packages_share_objects(tmp_path):
+    cache = compiler_cache.CompilerCache(tmp_path / "cache")
+    answer = "int answer(void){return 1;}"
+    first = _package(tmp_path / "first", main=MAIN, answer=answer)
+    second = _package(tmp_path / "second", main=MAIN, answer=answer)
+
+    _build(cache, first)
+    assert _build(cache, second, target="other").hits == 2
+
+
+@needs_compiler
+def test_relative_cache_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cache = compiler_cache.CompilerCache(Path("cache"))
+    package = _package(tmp_path / "package", main=MAIN, answer="int answer(void){return 1;}")
+    assert _build(cache, package).sources == 2
+    assert cache.stats().entries == 2
+
+
+@needs_compiler
+def test_unsplittable_build_scripts_run_as_is(tmp_path):
+    cache = compiler_cache.CompilerCache(tmp_path / "cache")
+    build_script = [COMPILER, "-x", "c", "-o", "hello", "main.c"]
+    with cache.compile(build_script, tmp_path, utils.Measurement()) as compiled:
+        assert compiled == compiler_cache.Compiled(build_script, 0, 0)
+    assert cache.stats().uncacheable == 1
+
+
+@needs_compiler
+def test_compile_errors_raise(tmp_path):
+    cache = compiler_cache.CompilerCache(tmp_path / "cache")
+    package = _package(tmp_path / "package", main="this is not C")
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        _build(cache, package)
+    assert error.value.output
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = compiler_cache.CompilerCache(tmp_path / "cache", max_size="10")
+    for key, age in (("aa" * 32, 0), ("bb" * 32, 100)):
+        entry = cache.objects_path / key[:2] / key
+        entry.parent.mkdir(parents=True)
+        entry.write_bytes(b"123456")
+        os.utime(str(entry), (age, age))
+
+    cache.evict()
+    assert [entry.name for entry in cache.objects_path.glob("*/*")] == ["bb" * 32]
+
+
+def test_evict_tolerates_concurrent_eviction(tmp_path, monkeypatch):
+    cache = compiler_cache.CompilerCache(tmp_path / "cache", max_size="0")
+    for key in ("aa" * 32, "bb" * 32):
+        entry = cache.objects_path / key[:2] / key
+        entry.parent.mkdir(parents=True)
+        entry.write_bytes(b"123456")
+    entries = cache._entries()
+    # Another process evicts one of them after we listed them
+    entries[0][0].unlink()
+    monkeypatch.setattr(cache, "_entries", lambda: entries)
+
+    cache.evict()
+    assert not list(cache.objects_path.glob("*/*"))
+
+
+def test_invalid_size_only_fails_when_used(tmp_path):
+    cache = compiler_cache.CompilerCache(tmp_path / "cache", max_size="lots")
+    cache.clear()
+    with pytest.raises(click.ClickException, match="BBIN_CACHE_SIZE"):
+        cache.stats()
+    with pytest.raises(click.ClickException, match="BBIN_CACHE_SIZE"):
+        with cache.compile(["cc", "-o", "hello", "main.c"], tmp_path, utils.Measurement()):
+            pass
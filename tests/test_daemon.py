@@ -0,0 +1,140 @@
+import json
+import threading
+import time
+
+import click
+import pytest
+
+from bbin import bbin, daemon
+
+
+@pytest.fixture
+def paths(tmp_path, monkeypatch):
+    """An initialized index, whose `git pull`s are only counted"""
+    monkeypatch.delenv("BBIN_NO_DAEMON", raising=False)
+    index_path = tmp_path / "index"
+    index_path.joinpath("repos", "hello_world").mkdir(parents=True)
+    index_path.joinpath(".git").mkdir()  # Looks like a clone, so it is only pulled
+    index_path.joinpath("index.json").write_text(
+        json.dumps(
+            {
+                "hello_world": "https://example.com/hello_world.git",
+                "goodbye_world": "https://example.com/goodbye_world.git",
+            }
+        )
+    )
+    tmp_path.joinpath("bin").mkdir()
+    tmp_path.joinpath("app").mkdir()
+    return {
+        "bbin_path": str(index_path),
+        "bin_path": str(tmp_path / "bin"),
+        "app_path": str(tmp_path / "app"),
+    }
+
+
+@pytest.fixture
+def pulls(monkeypatch):
+    pulled = []
+    monkeypatch.setattr(bbin.Index, "update", lambda index: pulled.append(index))
+    return pulled
+
+
+def test_request_without_daemon(tmp_path):
+    assert daemon.request("list", socket_path=str(tmp_path / "missing.sock")) is None
+
+
+def test_malformed_request():
+    response = daemon.Daemon().handle({"command": "list"})
+    assert response["ok"] is False
+    assert "Malformed request" in response["error"]
+
+
+def test_round_trip(tmp_path, paths, pulls):
+    socket_path = str(tmp_path / "bbind.sock")
+    state = daemon.Daemon()
+    server = daemon._Server(socket_path, state)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        assert daemon.is_running(socket_path)
+        found = daemon.request("search", socket_path=socket_path, query="WORLD", **paths)
+        assert found == ["goodbye_world", "hello_world"]
+        assert daemon.request("list", socket_path=socket_path, **paths) == ["hello_world"]
+        with pytest.raises(click.ClickException, match="Unknown command"):
+            daemon.request("frobnicate", socket_path=socket_path, **paths)
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+        state.shutdown()
+    # Every request was served by the same warm index
+    assert len(pulls) == 1
+
+
+def test_refreshes_stale_indexes(paths, pulls):
+    state = daemon.Daemon(refresh_interval=0)
+    index = state.get_index(**paths)
+    assert state.get_index(**paths) is index
+    assert len(pulls) == 2
+
+
+def test_keeps_fresh_indexes(paths, pulls):
+    state = daemon.Daemon(refresh_interval=3600)
+    state.get_index(**paths)
+    state.get_index(**paths)
+    assert len(pulls) == 1
+
+
+def test_install_honours_jobs(paths, pulls, monkeypatch):
+    running = []
+    most_at_once = []
+
+    def install_package(index, package_name, action):
+        running.append(package_name)
+        most_at_once.append(len(running))
+        time.sleep(0.05)
+        running.remove(package_name)
+
+    monkeypatch.setattr(bbin.Index, "install_package", install_package)
+    state = daemon.Daemon(workers=4)
+    try:
+        index = state.get_index(**paths)
+        packages = ["a", "b", "c", "d"]
+        assert state.install(index, packages, "move", jobs=2) == packages
+    finally:
+        state.shutdown()
+    assert max(most_at_once) == 2
+
+
+def test_install_falls_back_when_environments_differ(tmp_path, paths, pulls, monkeypatch):
+    installed = []
+    monkeypatch.setattr(
+        bbin.Index,
+        "install_package",
+        lambda index, package_name, action: installed.append(package_name),
+    )
+    socket_path = str(tmp_path / "bbind.sock")
+    state = daemon.Daemon()
+    server = daemon._Server(socket_path, state)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        arguments = dict(paths, packages=["hello_world"], action="move")
+        environment = daemon.build_environment()
+        assert daemon.request(
+            "install", socket_path=socket_path, environment=environment, **arguments
+        ) == ["hello_world"]
+        # e.g. the client turned the compiler cache off
+        environment["BBIN_NO_CACHE"] = "1"
+        assert (
+            daemon.request(
+                "install", socket_path=socket_path, environment=environment, **arguments
+            )
+            is None
+        )
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+        state.shutdown()
+    assert installed == ["hello_world"]
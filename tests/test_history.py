@@ -0,0 +1,59 @@
+import subprocess
+import sys
+
+import pytest
+
+from bbin import history, utils
+
+
+def _measurement(wall):
+    measurement = utils.Measurement()
+    measurement.wall = wall
+    return measurement
+
+
+def test_plan_starts_longest_first(tmp_path):
+    store = history.History(tmp_path / history.FILE_NAME)
+    store.record("short", "build", _measurement(1.0))
+    store.record("long", "clone", _measurement(2.0))
+    store.record("long", "build", _measurement(8.0))
+    store.record("medium", "build", _measurement(4.0))
+    store.record("medium", "build", _measurement(6.0))
+
+    plan = store.plan(["short", "medium", "long"], jobs=2)
+    assert [estimate.package_name for estimate in plan.estimates] == [
+        "long",
+        "medium",
+        "short",
+    ]
+    assert plan.wall_time == 10.0
+
+
+def test_unknown_packages_take_the_average(tmp_path):
+    store = history.History(tmp_path / history.FILE_NAME)
+    store.record("known", "build", _measurement(3.0))
+
+    plan = store.plan(["new", "known"])
+    assert plan.estimates[0].seconds is None
+    assert plan.wall_time == 6.0
+
+
+def test_measurements_are_per_process():
+    measurement = utils.Measurement()
+    big = "bytearray(64 * 1024 * 1024)"
+    utils.run_measured([sys.executable, "-c", big], measurement)
+    big_peak = measurement.max_rss
+
+    measurement = utils.Measurement()
+    output = utils.run_measured(
+        [sys.executable, "-c", "print('hi')"], measurement, stdout=subprocess.PIPE
+    ).stdout
+    assert output.strip() == b"hi"
+    assert measurement.wall > 0
+    if big_peak is not None:  # Not measured on Windows
+        assert measurement.max_rss < big_peak
+
+
+def test_failures_raise():
+    with pytest.raises(subprocess.CalledProcessError):
+        utils.run_measured([sys.executable, "-c", "raise SystemExit(3)"], utils.Measurement())
@@ -0,0 +1,46 @@
+import click
+import pytest
+
+from bbin import lockfile
+
+PACKAGE = lockfile.LockedPackage(
+    name="hello",
+    url="https://example.com/hello.git",
+    commit="0123456789abcdef0123456789abcdef01234567",
+    version="v1.0.0",
+    compiler={"for": "c"},
+    build={"Linux": {"generic": ["-o", "hello", "main.c"]}},
+    target="hello",
+    hashes={"Linux": {"generic": "abc"}},
+)
+
+
+def test_round_trip(tmp_path):
+    path = tmp_path / lockfile.FILE_NAME
+    lockfile.dump([PACKAGE], path)
+    assert lockfile.load(path) == {"hello": PACKAGE}
+
+
+def test_manifest_pins_the_commit():
+    assert PACKAGE.manifest()["version"] == PACKAGE.commit
+
+
+def test_invalid_lockfile(tmp_path):
+    path = tmp_path / lockfile.FILE_NAME
+    path.write_text('{"version": 1, "packages": {"hello": {"url": "x"}}}')
+    with pytest.raises(click.ClickException):
+        lockfile.load(path)
+
+
+def test_sync_state(tmp_path):
+    state = lockfile.SyncState(tmp_path / lockfile.STATE_FILE_NAME)
+    installed = tmp_path / "hello"
+    installed.write_bytes(b"built here")
+    assert not state.is_synced(PACKAGE, installed)
+
+    state.record(PACKAGE, installed)
+    assert state.is_synced(PACKAGE, installed)
+    # A different pin, or a binary changed behind our back, means syncing again
+    assert not state.is_synced(PACKAGE._replace(commit="f" * 40), installed)
+    installed.write_bytes(b"something else")
+    assert not state.is_synced(PACKAGE, installed)